@@ -1,11 +1,15 @@
 import os
+import asyncio
 import logging
 import datetime
+import heapq
+import itertools
+import random
 import re
-import threading
 import time
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from typing import Dict, List
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, List
+from aiohttp import web
 from dotenv import load_dotenv
 from telegram import (
     Update,
@@ -22,8 +26,10 @@ from telegram.ext import (
     ContextTypes
 )
 from telegram.error import Conflict
-from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.write_concern import WriteConcern
 from bson import ObjectId
 import pytz # Import pytz
 
@@ -38,23 +44,105 @@ PORT = int(os.getenv('PORT', 8080))
 # Get timezone from environment variable, default to Asia/Kolkata
 TIMEZONE = os.getenv('TIMEZONE', 'Asia/Kolkata')
 IST = pytz.timezone(TIMEZONE)
+# Set to 1 to (re)build all indexes at startup; a fresh database gets them regardless
+CREATE_INDEXES = os.getenv('CREATE_INDEXES', '0') == '1'
+
+
+# MongoDB setup (connected per event loop by connect_database)
+client = db = employees = attendance = holidays = meta = None
+
+def connect_database() -> None:
+    """Create a fresh Motor client; Motor binds to the event loop it first runs on"""
+    global client, db, employees, attendance, holidays, meta
+    if client is not None:
+        client.close()
+    client = AsyncIOMotorClient(
+        MONGODB_URI,
+        maxPoolSize=50,
+        minPoolSize=5,
+        serverSelectionTimeoutMS=3000
+    )
+    db = client.attendance_bot
+    employees = db.employees
+    # Attendance batches are idempotent; acknowledge from the primary only
+    attendance = db.get_collection("attendance", write_concern=WriteConcern(w=1))
+    holidays = db.holidays
+    meta = db.meta
+
+# Attendance documents use compact keys to keep documents and indexes small:
+#   eid: employee ObjectId, d: date, s: status (PRESENT/ABSENT), r: absence reason
+PRESENT, ABSENT = 1, 0
+
+# Bumped whenever migrate_legacy_documents gains a step; recorded in meta once applied
+SCHEMA_VERSION = 2
+
+# Legacy DD-MM-YYYY string dates as an aggregation expression
+_LEGACY_DATE = {"$dateFromString": {"dateString": "$date", "format": "%d-%m-%Y"}}
+
+async def migrate_legacy_documents() -> None:
+    """Convert documents written by earlier versions to the current schema"""
+    # Steady-state restarts skip the unindexed legacy-field scans below
+    marker = await meta.find_one({"_id": "schema"})
+    if marker and marker.get("version", 0) >= SCHEMA_VERSION:
+        return
+
+    await holidays.update_many({"date": {"$type": "string"}}, [{"$set": {"date": _LEGACY_DATE}}])
 
+    if await attendance.find_one({"employee_id": {"$exists": True}}, {"_id": 1}):
+        await _migrate_attendance_keys()
+
+    await meta.update_one(
+        {"_id": "schema"}, {"$set": {"version": SCHEMA_VERSION}}, upsert=True
+    )
 
-# MongoDB setup
-client = MongoClient(MONGODB_URI)
-db = client.attendance_bot
-employees = db.employees
-attendance = db.attendance
-holidays = db.holidays
+async def _migrate_attendance_keys() -> None:
+    """Rename legacy attendance fields to the compact keys and rebuild indexes"""
+    # The old unique index would treat every renamed document as a duplicate null key
+    existing = await attendance.index_information()
+    for name in ("employee_id_1_date_1", "date_1"):
+        if name in existing:
+            await attendance.drop_index(name)
+
+    await attendance.update_many({"employee_id": {"$exists": True}}, [
+        {"$set": {
+            "eid": {"$toObjectId": "$employee_id"},
+            "d": {"$cond": [{"$eq": [{"$type": "$date"}, "string"]}, _LEGACY_DATE, "$date"]},
+            "s": {"$cond": [{"$eq": ["$status", "present"]}, PRESENT, ABSENT]},
+            "r": "$reason"
+        }},
+        {"$unset": ["employee_id", "date", "status", "reason"]}
+    ])
+    await create_indexes()
+
+async def create_indexes() -> None:
+    """Create all indexes (idempotent, existing indexes are left as-is)"""
+    await asyncio.gather(
+        employees.create_index("name"),
+        employees.create_index(
+            [("active", 1), ("name", 1)],
+            partialFilterExpression={"active": True}
+        ),
+        attendance.create_index([("eid", 1), ("d", 1)], unique=True),
+        attendance.create_index("d"),
+        holidays.create_index("date", unique=True)
+    )
 
-# Create indexes
-employees.create_index("name")
-attendance.create_index([("employee_id", 1), ("date", 1)], unique=True)
-holidays.create_index("date", unique=True)
+async def setup_database(application: Application) -> None:
+    """Migrate legacy documents and create missing indexes once the event loop is running"""
+    await migrate_legacy_documents()
+    # Build indexes when requested, or when a fresh database has none yet
+    if CREATE_INDEXES or "eid_1_d_1" not in await attendance.index_information():
+        await create_indexes()
 
 # States for conversation
 SELECTING_ACTION, MARKING_ATTENDANCE, GETTING_REASON = range(3)
 
+# Attendance button callback data: p<simple ID> / a<simple ID>
+_CB_RE = re.compile(r'^[pa]\d+$')
+
+# Max operations per bulk_write when recording multiday absences
+ABSENCE_BATCH_SIZE = 50
+
 # Initialize logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -63,41 +151,97 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- HTTP Server for Render ---
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'Attendance Bot is running')
-
-def run_http_server():
-    server = HTTPServer(('', PORT), HealthCheckHandler)
+async def health_check(request: web.Request) -> web.Response:
+    return web.Response(text='Attendance Bot is running')
+
+async def start_http_server(application: Application) -> None:
+    """Serve health checks on the bot's event loop"""
+    app = web.Application()
+    app.router.add_get('/', health_check)
+    app.router.add_get('/healthz', health_check)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=PORT).start()
+    application.bot_data['http_runner'] = runner
     logger.info(f"HTTP server running on port {PORT}")
-    server.serve_forever()
+
+async def stop_http_server(application: Application) -> None:
+    runner = application.bot_data.pop('http_runner', None)
+    if runner:
+        await runner.cleanup()
 
 # --- Date Utilities ---
+_DATE_RE = re.compile(r'^(\d{2})-(\d{2})-(\d{4})$')
+
+@lru_cache(maxsize=1024)
 def parse_date(date_str: str) -> datetime.date:
     """Parse date from DD-MM-YYYY format"""
+    match = _DATE_RE.match(date_str)
+    if not match:
+        raise ValueError("Invalid date format. Use DD-MM-YYYY")
+    day, month, year = map(int, match.groups())
     try:
-        return datetime.datetime.strptime(date_str, "%d-%m-%Y").date()
+        return datetime.date(year, month, day)
     except ValueError:
         raise ValueError("Invalid date format. Use DD-MM-YYYY")
 
+@lru_cache(maxsize=4096)
 def format_date(date: datetime.date) -> str:
     """Format date to DD-MM-YYYY string"""
-    return date.strftime("%d-%m-%Y")
+    return f"{date.day:02d}-{date.month:02d}-{date.year}"
 
+@lru_cache(maxsize=4096)
 def format_date_long(date: datetime.date) -> str:
     """Format date to DD MMM YYYY string (e.g., 15-Jul-2025)"""
     return date.strftime("%d-%b-%Y")
 
+@lru_cache(maxsize=4096)
 def format_date_short(date: datetime.date) -> str:
     """Format date to DD MMM (e.g., 15-Jul)"""
     return date.strftime("%d-%b")
 
+def to_db_date(date: datetime.date) -> datetime.datetime:
+    """Convert date to the midnight datetime stored in MongoDB"""
+    return datetime.datetime.combine(date, datetime.time.min)
+
+@lru_cache(maxsize=1024)
 def validate_date(date_str: str) -> bool:
-    """Check if date string is in DD-MM-YYYY format"""
-    return bool(re.match(r'^\d{2}-\d{2}-\d{4}$', date_str))
+    """Check if date string is a real date in DD-MM-YYYY format"""
+    match = _DATE_RE.match(date_str)
+    if not match:
+        return False
+    day, month, year = map(int, match.groups())
+    if not (1 <= day <= 31 and 1 <= month <= 12):
+        return False
+    # Only reached for well-formed input; catches e.g. 31-02
+    try:
+        datetime.date(year, month, day)
+    except ValueError:
+        return False
+    return True
+
+# --- Employee Cache Utilities ---
+def bump_employees_version(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Invalidate cached employee lists after an add/remove"""
+    context.bot_data['employees_version'] = context.bot_data.get('employees_version', 0) + 1
+
+def get_employee_map(context: ContextTypes.DEFAULT_TYPE) -> Dict[str, ObjectId]:
+    """Return the simple ID mapping from /list_employees, or {} if it is stale"""
+    if context.user_data.get('employee_map_version') != context.bot_data.get('employees_version', 0):
+        return {}
+    return context.user_data.get('employee_map', {})
+
+async def get_active_employees(context: ContextTypes.DEFAULT_TYPE) -> List[dict]:
+    """Return active employees sorted by name, cached in bot_data until the next add/remove"""
+    version = context.bot_data.get('employees_version', 0)
+    cache = context.bot_data.get('employees_cache')
+    if cache is None or cache['version'] != version:
+        employee_list = await employees.find(
+            {"active": True}, {"name": 1}
+        ).sort("name", 1).batch_size(200).to_list(None)
+        cache = {"version": version, "list": employee_list}
+        context.bot_data['employees_cache'] = cache
+    return cache['list']
 
 # Function to get current IST date
 def get_current_ist_date():
@@ -161,10 +305,9 @@ async def add_employee(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     name = " ".join(context.args)
     try:
-        result = employees.insert_one({"name": name, "active": True})
-        # Clear employee map to force refresh
-        if 'employee_map' in context.user_data:
-            del context.user_data['employee_map']
+        result = await employees.insert_one({"name": name, "active": True})
+        # Invalidate employee map to force refresh
+        bump_employees_version(context)
         await update.message.reply_text(f"✅ Added new employee: {name}")
     except Exception as e:
         logger.error(f"Error adding employee: {e}")
@@ -174,23 +317,31 @@ async def list_employees(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
 
-    employee_list = list(employees.find({"active": True}, {"_id": 1, "name": 1}))
+    # Reuse the last listing if no employee was added or removed since
+    if get_employee_map(context):
+        await update.message.reply_text(context.user_data['employee_list_text'], parse_mode="Markdown")
+        return
+
+    employee_list = await get_active_employees(context)
 
     if not employee_list:
         await update.message.reply_text("No employees found")
         return
 
     # Create simple sequential IDs
-    response = "👥 *Employee List*\n"
+    parts = ["👥 *Employee List*\n"]
     employee_map = {}
 
     for idx, emp in enumerate(employee_list, 1):
         # Store mapping of simple ID to ObjectId
-        employee_map[str(idx)] = str(emp['_id'])
-        response += f"#{idx}: {emp['name']}\n"
+        employee_map[str(idx)] = emp['_id']
+        parts.append(f"#{idx}: {emp['name']}\n")
+    response = "".join(parts)
 
     # Store mapping in context
     context.user_data['employee_map'] = employee_map
+    context.user_data['employee_map_version'] = context.bot_data.get('employees_version', 0)
+    context.user_data['employee_list_text'] = response
     await update.message.reply_text(response, parse_mode="Markdown")
 
 async def remove_employee(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -201,7 +352,7 @@ async def remove_employee(update: Update, context: ContextTypes.DEFAULT_TYPE):
         simple_id = context.args[0]
 
         # Get employee mapping
-        employee_map = context.user_data.get('employee_map', {})
+        employee_map = get_employee_map(context)
 
         if not employee_map:
             await update.message.reply_text("❌ Employee list not loaded. Use /list_employees first.")
@@ -213,8 +364,8 @@ async def remove_employee(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Invalid employee ID")
             return
 
-        result = employees.update_one(
-            {"_id": ObjectId(emp_id)},
+        result = await employees.update_one(
+            {"_id": emp_id},
             {"$set": {"active": False}}
         )
 
@@ -223,8 +374,7 @@ async def remove_employee(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await update.message.reply_text(f"✅ Removed employee #{simple_id}")
             # Refresh employee map
-            if 'employee_map' in context.user_data:
-                del context.user_data['employee_map']
+            bump_employees_version(context)
     except (IndexError, ValueError):
         await update.message.reply_text("Usage: /remove_employee [id]")
     except Exception as e:
@@ -243,16 +393,16 @@ async def mark_attendance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ Sunday: Attendance not required")
         return
 
-    today_str = format_date(today)
+    # Check for a holiday while loading active employees
+    holiday_doc, employee_list = await asyncio.gather(
+        holidays.find_one({"date": to_db_date(today)}),
+        get_active_employees(context)
+    )
 
-    # Check if holiday
-    if holidays.find_one({"date": today_str}):
+    if holiday_doc:
         await update.message.reply_text("⛔ Today is a holiday")
         return
 
-    # Get active employees
-    employee_list = list(employees.find({"active": True}, {"_id": 1, "name": 1}))
-
     if not employee_list:
         await update.message.reply_text("❌ No active employees")
         return ConversationHandler.END
@@ -260,28 +410,32 @@ async def mark_attendance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Create simple ID mapping for attendance flow
     attendance_map = {}
     for idx, emp in enumerate(employee_list, 1):
-        attendance_map[str(idx)] = str(emp['_id'])
+        attendance_map[str(idx)] = emp['_id']
+
+    # Build every employee's Present/Absent keyboard once per session
+    markups = [
+        InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Present", callback_data=f"p{simple_id}"),  # p/a + simple ID
+            InlineKeyboardButton("❌ Absent", callback_data=f"a{simple_id}")
+        ]])
+        for simple_id in attendance_map
+    ]
 
     # Store employees in context
     context.user_data['attendance_flow'] = {
         'employees': employee_list,
         'attendance_map': attendance_map,  # Store mapping
+        'markups': markups,
         'current_index': 0,
         'attendance': {}
     }
 
     # Start with first employee
     emp = employee_list[0]
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Present", callback_data=f"present_1"),  # Use simple ID
-            InlineKeyboardButton("❌ Absent", callback_data=f"absent_1")
-        ]
-    ]
     await update.message.reply_text(
         f"🧑‍💼 *Employee #1: {emp['name']}*\n"
         f"📅 Date: {format_date_long(today)}",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=markups[0],
         parse_mode="Markdown"
     )
     return MARKING_ATTENDANCE
@@ -296,8 +450,9 @@ async def handle_attendance_choice(update: Update, context: ContextTypes.DEFAULT
     current_index = user_data['current_index']
     attendance_map = user_data['attendance_map']
 
-    # Process selection
-    status, simple_id = data.split('_')
+    # Process selection ("p3" / "a3": status initial + simple ID)
+    status = 'present' if data[0] == 'p' else 'absent'
+    simple_id = data[1:]
     emp_id = attendance_map[simple_id]
     user_data['attendance'][emp_id] = {'status': status}
 
@@ -309,7 +464,7 @@ async def handle_attendance_choice(update: Update, context: ContextTypes.DEFAULT
         return GETTING_REASON
 
     # Move to next employee
-    return await next_employee(update, context)
+    return await next_employee(update, context, query.edit_message_text)
 
 async def handle_reason(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reason = update.message.text
@@ -318,9 +473,19 @@ async def handle_reason(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_data['attendance'][emp_id]['reason'] = reason
 
     await update.message.reply_text("✅ Reason recorded")
-    return await next_employee(update, context)
+    return await next_employee(update, context, update.message.reply_text)
+
+async def _send_next_employee_prompt(send_fn: Callable[..., Awaitable], emp: dict, simple_id: str,
+                                     markup: InlineKeyboardMarkup):
+    await send_fn(
+        f"🧑‍💼 *Employee #{simple_id}: {emp['name']}*",
+        reply_markup=markup,
+        parse_mode="Markdown"
+    )
 
-async def next_employee(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def next_employee(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                        send_fn: Callable[..., Awaitable]):
+    """Prompt for the next employee using send_fn (edit or reply), or finish the flow"""
     user_data = context.user_data['attendance_flow']
     employee_list = user_data['employees']
     current_index = user_data['current_index'] + 1
@@ -331,55 +496,38 @@ async def next_employee(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Show next employee
     user_data['current_index'] = current_index
-    emp = employee_list[current_index]
     simple_id = str(current_index + 1)  # Simple ID is index + 1
-
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Present", callback_data=f"present_{simple_id}"),
-            InlineKeyboardButton("❌ Absent", callback_data=f"absent_{simple_id}")
-        ]
-    ]
-
-    if isinstance(update, Update) and update.message:
-        await update.message.reply_text(
-            f"🧑‍💼 *Employee #{simple_id}: {emp['name']}*",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown"
-        )
-    else:
-        await update.callback_query.edit_message_text(
-            f"🧑‍💼 *Employee #{simple_id}: {emp['name']}*",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown"
-        )
+    await _send_next_employee_prompt(
+        send_fn, employee_list[current_index], simple_id, user_data['markups'][current_index]
+    )
     return MARKING_ATTENDANCE
 
 async def finalize_attendance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_data = context.user_data['attendance_flow']
     today = get_current_ist_date() # Use IST date
-    today_str = format_date(today)
+    today_db = to_db_date(today)
 
-    # Save to database
-    records = []
+    # Save to database (upsert so re-marking a day overwrites instead of failing)
+    ops = []
     for emp_id, data in user_data['attendance'].items():
-        records.append({
-            "employee_id": emp_id,
-            "date": today_str,
-            "status": data['status'],
-            "reason": data.get('reason', "")
-        })
+        ops.append(UpdateOne(
+            {"eid": emp_id, "d": today_db},
+            {"$set": {"s": PRESENT if data['status'] == 'present' else ABSENT, "r": data.get('reason', "")}},
+            upsert=True
+        ))
 
     try:
-        attendance.insert_many(records, ordered=False)
+        await attendance.bulk_write(ops, ordered=False)
+        text = f"🎉 *Attendance for {format_date_long(today)} recorded successfully!*"
     except Exception as e:
         logger.error(f"Error saving attendance: {e}")
+        text = "❌ Failed to save attendance, please run /mark\\_attendance again"
 
     # Cleanup
     del context.user_data['attendance_flow']
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=f"🎉 *Attendance for {format_date_long(today)} recorded successfully!*",
+        text=text,
         parse_mode="Markdown"
     )
     return ConversationHandler.END
@@ -388,94 +536,103 @@ async def finalize_attendance(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def daily_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Today's attendance summary"""
     today = get_current_ist_date() # Use IST date
-    today_str = format_date(today)
+    today_db = to_db_date(today)
 
+    # Details and present/absent counts from a single group over the date
     pipeline = [
-        {"$match": {"date": today_str}},
+        {"$match": {"d": today_db}},
         {"$lookup": {
             "from": "employees",
-            "localField": "employee_id",
+            "localField": "eid",
             "foreignField": "_id",
             "as": "employee"
         }},
         {"$unwind": "$employee"},
-        {"$project": {
-            "name": "$employee.name",
-            "status": 1,
-            "reason": 1
+        {"$group": {
+            "_id": None,
+            "present": {"$sum": {"$cond": [{"$eq": ["$s", PRESENT]}, 1, 0]}},
+            "absent": {"$sum": {"$cond": [{"$eq": ["$s", ABSENT]}, 1, 0]}},
+            "records": {"$push": {
+                "name": "$employee.name",
+                "status": "$s",
+                "reason": "$r"
+            }}
         }}
     ]
 
-    records = list(attendance.aggregate(pipeline))
-
-    # Count present/absent
-    present_count = attendance.count_documents({"date": today_str, "status": "present"})
-    absent_count = attendance.count_documents({"date": today_str, "status": "absent"})
+    result = await attendance.aggregate(pipeline).to_list(None)
+    records = result[0]["records"] if result else []
+    present_count = result[0]["present"] if result else 0
+    absent_count = result[0]["absent"] if result else 0
 
     # Generate report
-    report = f"📊 *Daily Report - {format_date_long(today)}*\n"
-    report += f"✅ Present: {present_count} | ❌ Absent: {absent_count}\n\n"
+    parts = [f"📊 *Daily Report - {format_date_long(today)}*\n"]
+    parts.append(f"✅ Present: {present_count} | ❌ Absent: {absent_count}\n\n")
 
     if records:
-        report += "🧑‍💼 *Employee Details:*\n"
+        parts.append("🧑‍💼 *Employee Details:*\n")
         for record in records:
-            report += f"- {record['name']}: {'✅' if record['status'] == 'present' else '❌'}"
+            parts.append(f"- {record['name']}: {'✅' if record['status'] == PRESENT else '❌'}")
             if record.get('reason'):
-                report += f" ({record['reason']})"
-            report += "\n"
+                parts.append(f" ({record['reason']})")
+            parts.append("\n")
     else:
-        report += "No attendance recorded today"
+        parts.append("No attendance recorded today")
 
-    await update.message.reply_text(report, parse_mode="Markdown")
+    await update.message.reply_text("".join(parts), parse_mode="Markdown")
 
 async def date_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Report for specific date"""
     try:
-        date_str = context.args[0]
-        if not validate_date(date_str):
-            await update.message.reply_text("❌ Invalid date format. Use DD-MM-YYYY")
+        try:
+            target_date = parse_date(context.args[0])
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}")
             return
+        target_date_db = to_db_date(target_date)
 
-        target_date = parse_date(date_str)
-        date_str_db = format_date(target_date)
-
+        # Details and present/absent counts from a single group over the date
         pipeline = [
-            {"$match": {"date": date_str_db}},
+            {"$match": {"d": target_date_db}},
             {"$lookup": {
                 "from": "employees",
-                "localField": "employee_id",
+                "localField": "eid",
                 "foreignField": "_id",
                 "as": "employee"
             }},
             {"$unwind": "$employee"},
-            {"$project": {
-                "name": "$employee.name",
-                "status": 1,
-                "reason": 1
+            {"$group": {
+                "_id": None,
+                "present": {"$sum": {"$cond": [{"$eq": ["$s", PRESENT]}, 1, 0]}},
+                "absent": {"$sum": {"$cond": [{"$eq": ["$s", ABSENT]}, 1, 0]}},
+                "records": {"$push": {
+                    "name": "$employee.name",
+                    "status": "$s",
+                    "reason": "$r"
+                }}
             }}
         ]
 
-        records = list(attendance.aggregate(pipeline))
-
-        # Count present/absent
-        present_count = attendance.count_documents({"date": date_str_db, "status": "present"})
-        absent_count = attendance.count_documents({"date": date_str_db, "status": "absent"})
+        result = await attendance.aggregate(pipeline).to_list(None)
+        records = result[0]["records"] if result else []
+        present_count = result[0]["present"] if result else 0
+        absent_count = result[0]["absent"] if result else 0
 
         # Generate report
-        report = f"📅 *Date Report - {format_date_long(target_date)}*\n"
-        report += f"✅ Present: {present_count} | ❌ Absent: {absent_count}\n\n"
+        parts = [f"📅 *Date Report - {format_date_long(target_date)}*\n"]
+        parts.append(f"✅ Present: {present_count} | ❌ Absent: {absent_count}\n\n")
 
         if records:
-            report += "🧑‍💼 *Employee Details:*\n"
+            parts.append("🧑‍💼 *Employee Details:*\n")
             for record in records:
-                report += f"- {record['name']}: {'✅' if record['status'] == 'present' else '❌'}"
+                parts.append(f"- {record['name']}: {'✅' if record['status'] == PRESENT else '❌'}")
                 if record.get('reason'):
-                    report += f" ({record['reason']})"
-                report += "\n"
+                    parts.append(f" ({record['reason']})")
+                parts.append("\n")
         else:
-            report += "No attendance recorded on this date"
+            parts.append("No attendance recorded on this date")
 
-        await update.message.reply_text(report, parse_mode="Markdown")
+        await update.message.reply_text("".join(parts), parse_mode="Markdown")
     except IndexError:
         await update.message.reply_text("Usage: /date_report DD-MM-YYYY")
     except Exception as e:
@@ -500,29 +657,29 @@ async def monthly_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     first_day = today.replace(day=1)
     last_day = (today.replace(day=28) + datetime.timedelta(days=4)).replace(day=1) - datetime.timedelta(days=1)
 
-    # Convert dates to DD-MM-YYYY format for query
-    first_day_str = format_date(first_day)
-    last_day_str = format_date(last_day)
+    # Convert dates to stored datetimes for query
+    first_day_db = to_db_date(first_day)
+    last_day_db = to_db_date(last_day)
 
     # Get working days
-    working_days = attendance.distinct("date", {
-        "date": {"$gte": first_day_str, "$lte": last_day_str}
+    working_days = await attendance.distinct("d", {
+        "d": {"$gte": first_day_db, "$lte": last_day_db}
     })
 
     # Get holidays
-    holiday_list = list(holidays.find({
-        "date": {"$gte": first_day_str, "$lte": last_day_str}
-    }, {"date": 1, "description": 1}))
+    holiday_list = await holidays.find({
+        "date": {"$gte": first_day_db, "$lte": last_day_db}
+    }, {"date": 1, "description": 1}).to_list(None)
 
     # Employee performance
     pipeline = [
         {"$match": {
-            "date": {"$gte": first_day_str, "$lte": last_day_str},
+            "d": {"$gte": first_day_db, "$lte": last_day_db},
         }},
         {"$group": {
-            "_id": "$employee_id",
-            "present_days": {"$sum": {"$cond": [{"$eq": ["$status", "present"]}, 1, 0]}},
-            "absent_days": {"$sum": {"$cond": [{"$eq": ["$status", "absent"]}, 1, 0]}},
+            "_id": "$eid",
+            "present_days": {"$sum": {"$cond": [{"$eq": ["$s", PRESENT]}, 1, 0]}},
+            "absent_days": {"$sum": {"$cond": [{"$eq": ["$s", ABSENT]}, 1, 0]}},
             "total_days": {"$sum": 1}
         }},
         {"$lookup": {
@@ -540,74 +697,76 @@ async def monthly_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 {"$divide": ["$present_days", "$total_days"]},
                 100
             ]}
-        }}
+        }},
+        {"$addFields": {"percentage": {"$round": ["$percentage", 0]}}},
+        {"$sort": {"percentage": -1}}
     ]
 
-    employee_performance = list(attendance.aggregate(pipeline))
-
-    # Total counts
-    total_present = sum(emp['present_days'] for emp in employee_performance)
-    total_absent = sum(emp['absent_days'] for emp in employee_performance)
+    # Format employee rows and total counts as results stream in
+    rows = []
+    total_present = total_absent = 0
+    async for emp in attendance.aggregate(pipeline):
+        total_present += emp['present_days']
+        total_absent += emp['absent_days']
+        rows.append(f"- {emp['name']}: {emp.get('present_days', 0)}/{len(working_days)} ")
+        rows.append(f"({emp.get('percentage', 0):.0f}%)")
+        if emp.get('absent_days', 0) > 0:
+            rows.append(f" | ❌ Absences: {emp['absent_days']}")
+        rows.append("\n")
 
     # Generate report
-    report = f"📈 *Monthly Report - {today.strftime('%B %Y')}*\n"
-    report += f"📅 Period: {format_date_short(first_day)} to {format_date_short(last_day)}\n"
-    report += f"📊 Working Days: {len(working_days)} | Holidays: {len(holiday_list)}\n"
-    report += f"✅ Total Present: {total_present} | ❌ Total Absent: {total_absent}\n\n"
-
-    report += "👥 *Employee Performance:*\n"
-    for emp in sorted(employee_performance, key=lambda x: x['percentage'], reverse=True):
-        report += f"- {emp['name']}: {emp.get('present_days', 0)}/{len(working_days)} "
-        report += f"({emp.get('percentage', 0):.0f}%)"
-        if emp.get('absent_days', 0) > 0:
-            report += f" | ❌ Absences: {emp['absent_days']}"
-        report += "\n"
+    parts = [f"📈 *Monthly Report - {today.strftime('%B %Y')}*\n"]
+    parts.append(f"📅 Period: {format_date_short(first_day)} to {format_date_short(last_day)}\n")
+    parts.append(f"📊 Working Days: {len(working_days)} | Holidays: {len(holiday_list)}\n")
+    parts.append(f"✅ Total Present: {total_present} | ❌ Total Absent: {total_absent}\n\n")
+
+    parts.append("👥 *Employee Performance:*\n")
+    parts.extend(rows)
 
     # Top absence reasons
     reason_pipeline = [
         {"$match": {
-            "status": "absent",
-            "reason": {"$ne": None, "$ne": ""},
-            "date": {"$gte": first_day_str, "$lte": last_day_str}
+            "s": ABSENT,
+            "r": {"$nin": [None, ""]},
+            "d": {"$gte": first_day_db, "$lte": last_day_db}
         }},
         {"$group": {
-            "_id": "$reason",
+            "_id": "$r",
             "count": {"$sum": 1}
         }},
         {"$sort": {"count": -1}},
         {"$limit": 3}
     ]
 
-    top_reasons = list(attendance.aggregate(reason_pipeline))
+    top_reasons = await attendance.aggregate(reason_pipeline).to_list(None)
 
     if top_reasons:
-        report += "\n❌ *Top Absence Reasons:*\n"
+        parts.append("\n❌ *Top Absence Reasons:*\n")
         for reason in top_reasons:
-            report += f"- {reason['_id']}: {reason['count']} time{'s' if reason['count'] > 1 else ''}\n"
+            parts.append(f"- {reason['_id']}: {reason['count']} time{'s' if reason['count'] > 1 else ''}\n")
 
     if holiday_list:
-        report += "\n🗓️ *Holidays:*\n"
+        parts.append("\n🗓️ *Holidays:*\n")
         for holiday in holiday_list:
-            holiday_date = parse_date(holiday['date'])
-            report += f"- {format_date_short(holiday_date)}: {holiday['description']}\n"
+            parts.append(f"- {format_date_short(holiday['date'])}: {holiday['description']}\n")
 
-    await update.message.reply_text(report, parse_mode="Markdown")
+    await update.message.reply_text("".join(parts), parse_mode="Markdown")
 
 async def generate_period_report(update: Update, start_date: datetime.date,
                                 end_date: datetime.date, period_name: str):
     """Generate report for custom period"""
-    start_str = format_date(start_date)
-    end_str = format_date(end_date)
+    start_db = to_db_date(start_date)
+    end_db = to_db_date(end_date)
     total_days = (end_date - start_date).days + 1
 
     pipeline = [
         {"$match": {
-            "date": {"$gte": start_str, "$lte": end_str}
+            "d": {"$gte": start_db, "$lte": end_db}
         }},
         {"$group": {
-            "_id": "$employee_id",
-            "present": {"$sum": {"$cond": [{"$eq": ["$status", "present"]}, 1, 0]}},
-            "absent": {"$sum": {"$cond": [{"$eq": ["$status", "absent"]}, 1, 0]}}
+            "_id": "$eid",
+            "present": {"$sum": {"$cond": [{"$eq": ["$s", PRESENT]}, 1, 0]}},
+            "absent": {"$sum": {"$cond": [{"$eq": ["$s", ABSENT]}, 1, 0]}}
         }},
         {"$lookup": {
             "from": "employees",
@@ -628,41 +787,41 @@ async def generate_period_report(update: Update, start_date: datetime.date,
         }}
     ]
 
-    results = list(attendance.aggregate(pipeline))
+    results = await attendance.aggregate(pipeline).to_list(None)
 
     # Calculate totals
     total_present = sum(r["present"] for r in results)
     total_absent = sum(r["absent"] for r in results)
 
     # Generate report
-    report = f"📈 *{period_name} Report ({total_days} Days)*\n"
-    report += f"📅 Period: {format_date_short(start_date)} to {format_date_short(end_date)}\n"
-    report += f"✅ Total Present: {total_present} | ❌ Total Absent: {total_absent}\n\n"
-    report += "🏆 *Top Performers*\n"
+    parts = [f"📈 *{period_name} Report ({total_days} Days)*\n"]
+    parts.append(f"📅 Period: {format_date_short(start_date)} to {format_date_short(end_date)}\n")
+    parts.append(f"✅ Total Present: {total_present} | ❌ Total Absent: {total_absent}\n\n")
+    parts.append("🏆 *Top Performers*\n")
 
-    # Sort by attendance rate descending
-    top_performers = sorted(results, key=lambda x: x["rate"], reverse=True)[:3]
+    # Highest attendance rates
+    top_performers = heapq.nlargest(3, results, key=lambda x: x["rate"])
     for i, emp in enumerate(top_performers, 1):
-        report += f"{i}. {emp['name']}: {emp['rate']:.0f}%\n"
+        parts.append(f"{i}. {emp['name']}: {emp['rate']:.0f}%\n")
 
-    report += "\n⚠️ *Needs Improvement*\n"
-    # Sort by attendance rate ascending
-    needs_improvement = sorted(results, key=lambda x: x["rate"])[:3]
+    parts.append("\n⚠️ *Needs Improvement*\n")
+    # Lowest attendance rates
+    needs_improvement = heapq.nsmallest(3, results, key=lambda x: x["rate"])
     for i, emp in enumerate(needs_improvement, 1):
-        report += f"{i}. {emp['name']}: {emp['rate']:.0f}%\n"
+        parts.append(f"{i}. {emp['name']}: {emp['rate']:.0f}%\n")
 
     # Attendance distribution
-    report += "\n📊 *Attendance Distribution*\n"
-    report += f"✅ Present: {total_present} ({total_present/(total_present+total_absent)*100:.0f}%)\n"
-    report += f"❌ Absent: {total_absent} ({total_absent/(total_present+total_absent)*100:.0f}%)\n"
+    parts.append("\n📊 *Attendance Distribution*\n")
+    parts.append(f"✅ Present: {total_present} ({total_present/(total_present+total_absent)*100:.0f}%)\n")
+    parts.append(f"❌ Absent: {total_absent} ({total_absent/(total_present+total_absent)*100:.0f}%)\n")
 
-    await update.message.reply_text(report, parse_mode="Markdown")
+    await update.message.reply_text("".join(parts), parse_mode="Markdown")
 
 async def employee_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Individual performance report"""
     try:
         simple_id = context.args[0]
-        employee_map = context.user_data.get('employee_map', {})
+        employee_map = get_employee_map(context)
 
         if not employee_map:
             await update.message.reply_text("❌ Employee list not loaded. Use /list_employees first.")
@@ -675,7 +834,7 @@ async def employee_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Get employee details
-        employee = employees.find_one({"_id": ObjectId(emp_id)})
+        employee = await employees.find_one({"_id": emp_id})
         if not employee:
             await update.message.reply_text("❌ Employee not found")
             return
@@ -683,64 +842,69 @@ async def employee_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Last 30 days performance
         end_date = get_current_ist_date() # Use IST date
         start_date = end_date - datetime.timedelta(days=29)
-        start_str = format_date(start_date)
-        end_str = format_date(end_date)
+        start_db = to_db_date(start_date)
+        end_db = to_db_date(end_date)
 
         pipeline = [
             {"$match": {
-                "employee_id": emp_id,
-                "date": {"$gte": start_str, "$lte": end_str}
+                "eid": emp_id,
+                "d": {"$gte": start_db, "$lte": end_db}
             }},
             {"$group": {
                 "_id": None,
-                "present": {"$sum": {"$cond": [{"$eq": ["$status", "present"]}, 1, 0]}},
-                "absent": {"$sum": {"$cond": [{"$eq": ["$status", "absent"]}, 1, 0]}}
+                "present": {"$sum": {"$cond": [{"$eq": ["$s", PRESENT]}, 1, 0]}},
+                "absent": {"$sum": {"$cond": [{"$eq": ["$s", ABSENT]}, 1, 0]}}
             }}
         ]
 
-        result = list(attendance.aggregate(pipeline))
+        result = await attendance.aggregate(pipeline).to_list(None)
         present = result[0]["present"] if result else 0
         absent = result[0]["absent"] if result else 0
         total = present + absent
 
         # Generate report
-        report = f"👤 *Employee Report: {employee['name']}*\n"
-        report += f"🆔 Employee ID: #{simple_id}\n\n"
-        report += f"📅 Period: {format_date_short(start_date)} to {format_date_short(end_date)}\n"
-        report += f"✅ Present: {present} days\n"
-        report += f"❌ Absent: {absent} days\n"
-        report += f"📊 Attendance Rate: {round((present/total)*100) if total > 0 else 0}%\n\n"
+        parts = [f"👤 *Employee Report: {employee['name']}*\n"]
+        parts.append(f"🆔 Employee ID: #{simple_id}\n\n")
+        parts.append(f"📅 Period: {format_date_short(start_date)} to {format_date_short(end_date)}\n")
+        parts.append(f"✅ Present: {present} days\n")
+        parts.append(f"❌ Absent: {absent} days\n")
+        parts.append(f"📊 Attendance Rate: {round((present/total)*100) if total > 0 else 0}%\n\n")
 
         # Attendance trend (last 7 days)
         trend_start = end_date - datetime.timedelta(days=6)
-        trend_str = ""
-        for i in range(7):
-            day = trend_start + datetime.timedelta(days=i)
-            day_str = format_date(day)
-            record = attendance.find_one({"employee_id": emp_id, "date": day_str})
-            if record:
-                trend_str += "✅" if record['status'] == 'present' else "❌"
+        days = [to_db_date(trend_start + datetime.timedelta(days=i)) for i in range(7)]
+        trend_records = await attendance.find(
+            {"eid": emp_id, "d": {"$in": days}},
+            {"d": 1, "s": 1}
+        ).to_list(None)
+        status_by_date = {doc["d"]: doc["s"] for doc in trend_records}
+        trend = []
+        for day in days:
+            status = status_by_date.get(day)
+            if status is None:
+                trend.append("⬜")
             else:
-                trend_str += "⬜"
-        report += f"📈 *Weekly Trend:*\n{trend_str}\n\n"
+                trend.append("✅" if status == PRESENT else "❌")
+        trend_str = "".join(trend)
+        parts.append(f"📈 *Weekly Trend:*\n{trend_str}\n\n")
 
-        report += f"📝 *Recent Absences:*\n"
+        parts.append(f"📝 *Recent Absences:*\n")
 
         # Get last 3 absences with reasons
-        absences = attendance.find({
-            "employee_id": emp_id,
-            "status": "absent"
-        }).sort("date", -1).limit(3)
+        absences = await attendance.find({
+            "eid": emp_id,
+            "s": ABSENT
+        }).sort("d", -1).limit(3).to_list(None)
 
         if absences:
             for i, absence in enumerate(absences, 1):
-                date_str = absence["date"]
-                reason = absence.get("reason", "No reason provided")
-                report += f"{i}. {date_str}: {reason}\n"
+                date_str = format_date(absence["d"])
+                reason = absence.get("r", "No reason provided")
+                parts.append(f"{i}. {date_str}: {reason}\n")
         else:
-            report += "No absences in the last 30 days\n"
+            parts.append("No absences in the last 30 days\n")
 
-        await update.message.reply_text(report, parse_mode="Markdown")
+        await update.message.reply_text("".join(parts), parse_mode="Markdown")
     except IndexError:
         await update.message.reply_text("Usage: /employee_report [ID]")
     except Exception as e:
@@ -761,10 +925,9 @@ async def mark_holiday(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     today = get_current_ist_date() # Use IST date
-    today_str = format_date(today)
     try:
-        holidays.insert_one({
-            "date": today_str,
+        await holidays.insert_one({
+            "date": to_db_date(today),
             "description": description
         })
         await update.message.reply_text(f"🎉 Marked {format_date_long(today)} as holiday: {description}")
@@ -778,16 +941,17 @@ async def list_holidays(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
 
-    holiday_list = list(holidays.find().sort("date", 1))
+    lines = []
+    async for hol in holidays.find(
+        {}, {"date": 1, "description": 1, "_id": 0}
+    ).sort("date", 1):
+        lines.append(f"- {format_date_long(hol['date'])}: {hol['description']}")
 
-    if not holiday_list:
+    if not lines:
         await update.message.reply_text("No holidays scheduled")
         return
 
-    response = "🗓️ *Upcoming Holidays*\n" + "\n".join(
-        [f"- {format_date_long(parse_date(hol['date']))}: {hol['description']}"
-         for hol in holiday_list]
-    )
+    response = "🗓️ *Upcoming Holidays*\n" + "\n".join(lines)
     await update.message.reply_text(response, parse_mode="Markdown")
 
 async def remove_holiday(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -798,14 +962,12 @@ async def remove_holiday(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not context.args:
             raise ValueError
 
-        date_str = context.args[0]
-        if not validate_date(date_str):
-            await update.message.reply_text("❌ Invalid date format. Use DD-MM-YYYY")
+        try:
+            holiday_date = parse_date(context.args[0])
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}")
             return
-
-        holiday_date = parse_date(date_str)
-        date_str_formatted = format_date(holiday_date)
-        result = holidays.delete_one({"date": date_str_formatted})
+        result = await holidays.delete_one({"date": to_db_date(holiday_date)})
 
         if result.deleted_count == 0:
             await update.message.reply_text(f"❌ No holiday found on {format_date_long(holiday_date)}")
@@ -829,7 +991,7 @@ async def multiday_absence(update: Update, context: ContextTypes.DEFAULT_TYPE):
         simple_id = context.args[0]
 
         # Get employee mapping
-        employee_map = context.user_data.get('employee_map', {})
+        employee_map = get_employee_map(context)
 
         if not employee_map:
             await update.message.reply_text("❌ Employee list not loaded. Use /list_employees first.")
@@ -855,7 +1017,7 @@ async def multiday_absence(update: Update, context: ContextTypes.DEFAULT_TYPE):
         start_date = parse_date(start_date_str)
         end_date = parse_date(end_date_str)
 
-        reason = " ".join(context.args[3:]) if len(context.args) > 3 else "Not specified"
+        reason = " ".join(itertools.islice(context.args, 3, None)) or "Not specified"
     except (IndexError, ValueError):
         await update.message.reply_text(
             "Usage: /multiday_absence [id] [start_DD-MM-YYYY] [end_DD-MM-YYYY] [reason]"
@@ -867,83 +1029,112 @@ async def multiday_absence(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Error: Start date must be before end date")
         return
 
-    # Process each day
-    current_date = start_date
-    days_processed = 0
-    records = []
-
-    while current_date <= end_date:
-        # Skip Sundays and holidays
-        if current_date.weekday() == 6:  # Sunday
-            current_date += datetime.timedelta(days=1)
-            continue
-
-        date_str = format_date(current_date)
-        if holidays.find_one({"date": date_str}):
-            current_date += datetime.timedelta(days=1)
-            continue
-
-        # Create absence record
-        records.append({
-            "employee_id": emp_id,
-            "date": date_str,
-            "status": "absent",
-            "reason": reason
-        })
-        days_processed += 1
-        current_date += datetime.timedelta(days=1)
+    # Fetch all holidays in the range up front
+    holiday_dates = {
+        h["date"] async for h in holidays.find(
+            {"date": {"$gte": to_db_date(start_date), "$lte": to_db_date(end_date)}},
+            {"date": 1, "_id": 0}
+        )
+    }
 
-    # Insert records
-    if records:
+    # Working days in the range: ordinals minus Sundays ((ordinal - 1) % 7 == 6), minus holidays
+    from_ordinal = datetime.date.fromordinal
+    _datetime = datetime.datetime
+    ord_range = range(start_date.toordinal(), end_date.toordinal() + 1)
+    business_dates = [
+        _datetime(d.year, d.month, d.day)
+        for d in map(from_ordinal, (o for o in ord_range if (o - 1) % 7 != 6))
+    ]
+    absence_dates = [d for d in business_dates if d not in holiday_dates]
+
+    # Create absence records (upsert so overlapping reruns overwrite); the
+    # update document is shared and each filter is a copy of one template
+    absence_filter = {"eid": emp_id}
+    absence_update = {"$set": {"s": ABSENT, "r": reason}}
+    ops = [UpdateOne(dict(absence_filter, d=d), absence_update, upsert=True) for d in absence_dates]
+    days_processed = len(ops)
+
+    # Write records in batches so long ranges don't become one large request
+    if ops:
+        written = 0
         try:
-            attendance.insert_many(records, ordered=False)
+            for i in range(0, len(ops), ABSENCE_BATCH_SIZE):
+                try:
+                    result = await attendance.bulk_write(ops[i:i + ABSENCE_BATCH_SIZE], ordered=False)
+                    written += result.upserted_count + result.matched_count
+                except BulkWriteError as bwe:
+                    logger.error(f"Error inserting multiday absence: {bwe.details['writeErrors']}")
+                    written += bwe.details["nUpserted"] + bwe.details["nMatched"]
+            days_processed = written
         except Exception as e:
             logger.error(f"Error inserting multiday absence: {e}")
-            days_processed = f"~{days_processed} (some may have been recorded)"
+            days_processed = f"{written} of {len(ops)}"
 
     await update.message.reply_text(
         f"✅ Marked {days_processed} days absence for employee #{simple_id} "
         f"from {format_date_short(start_date)} to {format_date_short(end_date)}"
     )
 
-# --- Main Function ---
-def main() -> None:
-    # Start HTTP server in a separate thread
-    http_thread = threading.Thread(target=run_http_server, daemon=True)
-    http_thread.start()
-
-    # Create Telegram application
-    application = Application.builder().token(BOT_TOKEN).build()
-
-    # Register commands
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("add_employee", add_employee))
-    application.add_handler(CommandHandler("list_employees", list_employees))
-    application.add_handler(CommandHandler("remove_employee", remove_employee))
+# --- Command Table ---
+# (name, handler, block): slow database commands run with block=False so they
+# don't hold up other users; the attendance conversation stays blocking.
+COMMANDS = (
+    ("start", start, True),
+    ("help", help_command, True),
+    ("add_employee", add_employee, True),
+    ("list_employees", list_employees, True),
+    ("remove_employee", remove_employee, True),
 
     # Report commands
-    application.add_handler(CommandHandler("daily_report", daily_report))
-    application.add_handler(CommandHandler("date_report", date_report))
-    application.add_handler(CommandHandler("last_7_days", last_7_days_report))
-    application.add_handler(CommandHandler("last_30_days", last_30_days_report))
-    application.add_handler(CommandHandler("monthly_report", monthly_report))
-    application.add_handler(CommandHandler("employee_report", employee_report))
+    ("daily_report", daily_report, False),
+    ("date_report", date_report, False),
+    ("last_7_days", last_7_days_report, False),
+    ("last_30_days", last_30_days_report, False),
+    ("monthly_report", monthly_report, False),
+    ("employee_report", employee_report, False),
 
     # Holiday commands
-    application.add_handler(CommandHandler("mark_holiday", mark_holiday))
-    application.add_handler(CommandHandler("list_holidays", list_holidays))
-    application.add_handler(CommandHandler("remove_holiday", remove_holiday))
+    ("mark_holiday", mark_holiday, True),
+    ("list_holidays", list_holidays, True),
+    ("remove_holiday", remove_holiday, True),
 
     # Other commands
-    application.add_handler(CommandHandler("multiday_absence", multiday_absence))
+    ("multiday_absence", multiday_absence, False),
+)
+
+# --- Main Function ---
+async def post_init(application: Application) -> None:
+    """Start the health-check server and prepare the database"""
+    await start_http_server(application)
+    await setup_database(application)
+
+def main() -> None:
+    # Use uvloop as the event loop when available (not supported on Windows)
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
+    # Create Telegram application (health-check server runs on the same loop)
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(stop_http_server)
+        .build()
+    )
+
+    # Register commands
+    for name, handler, block in COMMANDS:
+        application.add_handler(CommandHandler(name, handler, block=block))
 
     # Attendance conversation handler
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('mark_attendance', mark_attendance)],
         states={
             MARKING_ATTENDANCE: [
-                CallbackQueryHandler(handle_attendance_choice, pattern=r'^(present|absent)_\d+$')
+                CallbackQueryHandler(handle_attendance_choice, pattern=_CB_RE)
             ],
             GETTING_REASON: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_reason)
@@ -956,22 +1147,29 @@ def main() -> None:
 
     # Start the bot with restart logic
     max_retries = 5
-    retry_delay = 10  # seconds
+    retry_delay = 10  # seconds, doubled after each failure
+    max_retry_delay = 300
 
     while max_retries > 0:
+        # Jitter keeps competing instances from reconnecting in lockstep
+        delay = retry_delay + random.uniform(0, retry_delay * 0.3)
+        # run_polling closes its loop on exit, so each attempt needs a new one
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        connect_database()
         try:
             logger.info("Starting bot polling...")
             application.run_polling()
             break  # Exit loop if polling stops cleanly
         except Conflict as e:
             logger.error(f"Conflict detected: {e}")
-            logger.info(f"Retrying in {retry_delay} seconds... ({max_retries} retries left)")
+            logger.info(f"Retrying in {delay:.0f} seconds... ({max_retries} retries left)")
             max_retries -= 1
-            time.sleep(retry_delay)
+            time.sleep(delay)
         except Exception as e:
+            # e.g. MongoDB unreachable during setup; exit so the host can restart us
             logger.error(f"Unexpected error: {e}")
-            logger.info("Restarting bot...")
-            time.sleep(retry_delay)
+            raise
+        retry_delay = min(retry_delay * 2, max_retry_delay)
 
     if max_retries <= 0:
         logger.error("Max retries exceeded. Bot stopped.")